@@ -1,14 +1,18 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import Response, JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import hashlib
+import io
 import os
 import sys
-import shutil
-import tempfile
+import time
+from collections import OrderedDict
 from io import BytesIO
 from PIL import Image
 import zipfile
-import requests
+import httpx
+import orjson
 
 # Ensure project root is on path to import table_cropper
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -19,8 +23,80 @@ if PROJECT_ROOT not in sys.path:
 from table_cropper import AdvancedTableCropper  # noqa: E402
 
 
+class ZipStream(io.RawIOBase):
+    """Write-only sink that buffers zip bytes until the response generator drains them."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def encode_image(pil_img: Image.Image, image_format: str = "png") -> bytes:
+    """Encode a PIL image to PNG or JPEG bytes, normalizing the mode if needed.
+
+    PNG uses compress_level=1: the crops are photographic, so deeper DEFLATE
+    effort costs several times the CPU for a few percent smaller files. JPEG
+    is offered for callers that don't need lossless output.
+    """
+    save_img = pil_img
+    buf = BytesIO()
+    if image_format == "jpeg":
+        if save_img.mode != "RGB":
+            save_img = save_img.convert("RGB")
+        save_img.save(buf, format="JPEG", quality=92)
+    else:
+        if save_img.mode not in ("RGB", "RGBA"):
+            save_img = save_img.convert("RGB")
+        save_img.save(buf, format="PNG", compress_level=1, optimize=False)
+    return buf.getvalue()
+
+
+def validate_image_format(image_format: str) -> str:
+    image_format = (image_format or "png").lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if image_format not in ("png", "jpeg"):
+        raise HTTPException(status_code=400, detail="Unsupported output format. Use png or jpeg.")
+    return image_format
+
+
 app = FastAPI(title="DKN Table Cropper API (FastAPI)", version="1.0.0")
 
+# One cropper for the process lifetime. It is safe to share across requests:
+# its reused scratch/warp buffers are thread-local and its result caches are
+# lock-protected, so concurrent to_thread workers stay independent.
+cropper = AdvancedTableCropper()
+
+# LRU of recent pipeline results keyed by SHA-256 of the uploaded bytes, so
+# clients that hit /part1 then /part2 with the same image only pay for the
+# perspective-correction pipeline once.
+_result_cache: "OrderedDict[bytes, dict]" = OrderedDict()
+_RESULT_CACHE_MAX = 32
+
+# Shared client so uploads reuse connections instead of paying a fresh TLS
+# handshake per request.
+http_client = httpx.AsyncClient(timeout=30)
+
+_ALLOWED_CONTENT_TYPES = frozenset({
+    "image/png", "image/jpeg", "image/jpg", "image/bmp", "image/tiff",
+})
+
+# Recent tmpfiles.org uploads keyed by SHA-256 of the bytes, so re-submitting
+# the same image (common in dev/test) skips the network round-trip. TTL stays
+# under tmpfiles.org's own 1h link expiry.
+_upload_cache: "dict[bytes, tuple[float, str]]" = {}
+_UPLOAD_CACHE_TTL = 3300  # seconds
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -30,47 +106,62 @@ app.add_middleware(
 )
 
 
+@app.on_event("shutdown")
+async def close_http_client():
+    # Drain the shared client's connection pool on server exit so sockets
+    # aren't left to the GC
+    await http_client.aclose()
+
+
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "service": "DKN Table Cropper API (FastAPI)", "version": "1.0.0"}
 
 
-def process_image_internal(image: UploadFile):
+async def process_image_internal(image: UploadFile):
     """Internal function to process image and return results"""
     # Basic content-type validation
-    if image.content_type is None or not any(
-        image.content_type.lower().endswith(ext) for ext in ["jpeg", "jpg", "png", "bmp", "tiff"]
-    ):
+    if (image.content_type or "").lower() not in _ALLOWED_CONTENT_TYPES:
         raise HTTPException(status_code=400, detail="Unsupported file type. Upload PNG/JPG/JPEG/BMP/TIFF.")
 
-    # Create an isolated temp working directory
-    with tempfile.TemporaryDirectory() as work_dir:
-        # Preserve the original filename base for output naming
-        original_name = os.path.basename(image.filename or "uploaded.png")
-        if "." in original_name:
-            base_name, ext = os.path.splitext(original_name)
-        else:
-            base_name, ext = original_name, ".png"
-
-        input_path = os.path.join(work_dir, original_name)
+    # Preserve the original filename base for output naming (single pass,
+    # no splitext/"." scan combo)
+    original_name = os.path.basename(image.filename or "uploaded.png")
+    stem, _, _ = original_name.rpartition(".")
+    base_name = stem or original_name
 
-        # Persist uploaded file to disk
-        with open(input_path, "wb") as f:
-            shutil.copyfileobj(image.file, f)
+    # Feed the upload straight to the shared cropper; no tempdir round-trip
+    data = await image.read()
 
-        # Process with AdvancedTableCropper in-memory
-        cropper = AdvancedTableCropper()
-        result = cropper.process_image(input_path, output_dir=None, return_images=True)
-        
+    digest = hashlib.sha256(data).digest()
+    result = _result_cache.get(digest)
+    if result is not None:
+        _result_cache.move_to_end(digest)
         return result, base_name
 
+    # The pipeline is pure CPU (OpenCV warp + contour work); run it off the
+    # event loop so concurrent requests keep making progress.
+    result = await asyncio.to_thread(cropper.process_image_bytes, data, original_name)
+    if result:
+        _result_cache[digest] = result
+        while len(_result_cache) > _RESULT_CACHE_MAX:
+            _result_cache.popitem(last=False)
+
+    return result, base_name
 
-def upload_to_tmpfiles(image_bytes: bytes, filename: str) -> str:
+
+async def upload_to_tmpfiles(image_bytes: bytes, filename: str) -> str:
     """Upload image to tmpfiles.org and return the public URL"""
+    digest = hashlib.sha256(image_bytes).digest()
+    now = time.time()
+    cached = _upload_cache.get(digest)
+    if cached is not None and now - cached[0] < _UPLOAD_CACHE_TTL:
+        return cached[1]
+
     try:
         files = {"file": (filename, image_bytes, "image/png")}
-        response = requests.post("https://tmpfiles.org/api/v1/upload", files=files)
-        
+        response = await http_client.post("https://tmpfiles.org/api/v1/upload", files=files)
+
         if response.status_code == 200:
             data = response.json()
             if data.get("status") == "success":
@@ -85,7 +176,13 @@ def upload_to_tmpfiles(image_bytes: bytes, filename: str) -> str:
                     # If the URL doesn't have /dl/, add it
                     if "/dl/" not in file_url:
                         file_url = file_url.replace("tmpfiles.org/", "tmpfiles.org/dl/")
-                    
+
+                    # Cache the URL and drop anything past its TTL
+                    _upload_cache[digest] = (now, file_url)
+                    for key in [k for k, (ts, _) in _upload_cache.items()
+                                if now - ts >= _UPLOAD_CACHE_TTL]:
+                        del _upload_cache[key]
+
                     return file_url
         
         raise Exception(f"Upload failed: {response.text}")
@@ -94,22 +191,21 @@ def upload_to_tmpfiles(image_bytes: bytes, filename: str) -> str:
 
 
 @app.post("/api/process/part1")
-async def process_part1(image: UploadFile = File(...)):
+async def process_part1(image: UploadFile = File(...), image_format: str = Query("png", alias="format")):
     """Process image and return part 1 (rows 1-8) uploaded to tmpfiles.org"""
     try:
-        result, base_name = process_image_internal(image)
-        
-        # Convert part1 to bytes
-        img_buffer = BytesIO()
-        save_img = result["part1"]
-        if save_img.mode not in ("RGB", "RGBA"):
-            save_img = save_img.convert("RGB")
-        save_img.save(img_buffer, format="PNG")
-        
+        # Reject a bad ?format= before paying for the decode+warp pipeline
+        image_format = validate_image_format(image_format)
+
+        result, base_name = await process_image_internal(image)
+
+        # Convert part1 to bytes (no-op mode conversion when already RGB/RGBA)
+        image_bytes = await asyncio.to_thread(encode_image, result["part1"], image_format)
+
         # Upload to tmpfiles.org
-        filename = f"{base_name}_part1_rows1-8.png"
-        image_bytes = img_buffer.getvalue()
-        public_url = upload_to_tmpfiles(image_bytes, filename)
+        ext = "jpg" if image_format == "jpeg" else "png"
+        filename = f"{base_name}_part1_rows1-8.{ext}"
+        public_url = await upload_to_tmpfiles(image_bytes, filename)
         
         return JSONResponse(content={
             "status": "success",
@@ -127,22 +223,21 @@ async def process_part1(image: UploadFile = File(...)):
 
 
 @app.post("/api/process/part2")
-async def process_part2(image: UploadFile = File(...)):
+async def process_part2(image: UploadFile = File(...), image_format: str = Query("png", alias="format")):
     """Process image and return part 2 (rows 9-17) uploaded to tmpfiles.org"""
     try:
-        result, base_name = process_image_internal(image)
-        
-        # Convert part2 to bytes
-        img_buffer = BytesIO()
-        save_img = result["part2"]
-        if save_img.mode not in ("RGB", "RGBA"):
-            save_img = save_img.convert("RGB")
-        save_img.save(img_buffer, format="PNG")
-        
+        # Reject a bad ?format= before paying for the decode+warp pipeline
+        image_format = validate_image_format(image_format)
+
+        result, base_name = await process_image_internal(image)
+
+        # Convert part2 to bytes (no-op mode conversion when already RGB/RGBA)
+        image_bytes = await asyncio.to_thread(encode_image, result["part2"], image_format)
+
         # Upload to tmpfiles.org
-        filename = f"{base_name}_part2_rows9-17.png"
-        image_bytes = img_buffer.getvalue()
-        public_url = upload_to_tmpfiles(image_bytes, filename)
+        ext = "jpg" if image_format == "jpeg" else "png"
+        filename = f"{base_name}_part2_rows9-17.{ext}"
+        public_url = await upload_to_tmpfiles(image_bytes, filename)
         
         return JSONResponse(content={
             "status": "success",
@@ -160,45 +255,42 @@ async def process_part2(image: UploadFile = File(...)):
 
 
 @app.post("/api/process/both")
-async def process_both_parts(image: UploadFile = File(...)):
+async def process_both_parts(image: UploadFile = File(...), image_format: str = Query("png", alias="format")):
     """Process image and return both part1 and part2 uploaded to tmpfiles.org"""
     try:
-        result, base_name = process_image_internal(image)
-        
-        # Process part1
-        img_buffer1 = BytesIO()
-        save_img1 = result["part1"]
-        if save_img1.mode not in ("RGB", "RGBA"):
-            save_img1 = save_img1.convert("RGB")
-        save_img1.save(img_buffer1, format="PNG")
-        
-        # Process part2
-        img_buffer2 = BytesIO()
-        save_img2 = result["part2"]
-        if save_img2.mode not in ("RGB", "RGBA"):
-            save_img2 = save_img2.convert("RGB")
-        save_img2.save(img_buffer2, format="PNG")
-        
-        # Upload both to tmpfiles.org
-        filename1 = f"{base_name}_part1_rows1-8.png"
-        filename2 = f"{base_name}_part2_rows9-17.png"
-        
-        url1 = upload_to_tmpfiles(img_buffer1.getvalue(), filename1)
-        url2 = upload_to_tmpfiles(img_buffer2.getvalue(), filename2)
-        
+        # Reject a bad ?format= before paying for the decode+warp pipeline
+        image_format = validate_image_format(image_format)
+
+        result, base_name = await process_image_internal(image)
+        ext = "jpg" if image_format == "jpeg" else "png"
+        filename1 = f"{base_name}_part1_rows1-8.{ext}"
+        filename2 = f"{base_name}_part2_rows9-17.{ext}"
+
+        # Pipeline per part: each upload starts the moment its own encode is
+        # done, so CPU (encode) overlaps network I/O (upload) across parts.
+        async def encode_and_upload(pil_img, filename):
+            image_bytes = await asyncio.to_thread(encode_image, pil_img, image_format)
+            url = await upload_to_tmpfiles(image_bytes, filename)
+            return image_bytes, url
+
+        (png1, url1), (png2, url2) = await asyncio.gather(
+            encode_and_upload(result["part1"], filename1),
+            encode_and_upload(result["part2"], filename2),
+        )
+
         return JSONResponse(content={
             "status": "success",
             "part1": {
                 "description": "Rows 1-8",
                 "filename": filename1,
                 "url": url1,
-                "size_bytes": len(img_buffer1.getvalue())
+                "size_bytes": len(png1)
             },
             "part2": {
-                "description": "Rows 9-17", 
+                "description": "Rows 9-17",
                 "filename": filename2,
                 "url": url2,
-                "size_bytes": len(img_buffer2.getvalue())
+                "size_bytes": len(png2)
             }
         })
         
@@ -209,36 +301,52 @@ async def process_both_parts(image: UploadFile = File(...)):
 
 
 @app.post("/api/process")
-async def process(image: UploadFile = File(...)):
+async def process(image: UploadFile = File(...), image_format: str = Query("png", alias="format")):
     """Process image and return ZIP with all results (original behavior)"""
     try:
-        result, base_name = process_image_internal(image)
-
-        # Package all images into a single zip in-memory
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zipf:
-            def add_image_to_zip(pil_img: Image.Image, filename: str) -> None:
-                buf = BytesIO()
-                save_img = pil_img
-                if pil_img.mode not in ("RGB", "RGBA"):
-                    save_img = pil_img.convert("RGB")
-                save_img.save(buf, format="PNG")
-                zipf.writestr(filename, buf.getvalue())
-
-            add_image_to_zip(result["cropped_table"], f"{base_name}_cropped_table.png")
-            add_image_to_zip(result["part1"], f"{base_name}_part1_rows1-8.png")
-            add_image_to_zip(result["part2"], f"{base_name}_part2_rows9-17.png")
-
-            # Include metadata JSON
-            meta_buf = BytesIO()
-            import json as _json
-            meta_buf.write(_json.dumps(result.get("metadata", {}), indent=2).encode("utf-8"))
-            zipf.writestr(f"{base_name}_metadata.json", meta_buf.getvalue())
+        # Reject a bad ?format= before paying for the decode+warp pipeline
+        image_format = validate_image_format(image_format)
+
+        result, base_name = await process_image_internal(image)
+
+        # Encode the three PNGs concurrently; Pillow's PNG encoder releases the
+        # GIL while compressing, so threads overlap the CPU work without the
+        # pickling cost a process pool would add for full rasters.
+        ext = "jpg" if image_format == "jpeg" else "png"
+        entries = [
+            (f"{base_name}_cropped_table.{ext}", result["cropped_table"]),
+            (f"{base_name}_part1_rows1-8.{ext}", result["part1"]),
+            (f"{base_name}_part2_rows9-17.{ext}", result["part2"]),
+        ]
+        encoded = await asyncio.gather(
+            *(asyncio.to_thread(encode_image, img, image_format) for _, img in entries)
+        )
+
+        # Stream the zip straight into the response instead of building it in a
+        # BytesIO and copying the whole buffer out with .getvalue().
+        # PNGs are already DEFLATE-compressed, so store them as-is instead of
+        # re-running DEFLATE over them; only the small metadata JSON is worth
+        # compressing (see the explicit compress_type below).
+        def iter_zip():
+            stream = ZipStream()
+            with zipfile.ZipFile(stream, mode="w", compression=zipfile.ZIP_STORED) as zipf:
+                for (filename, _), png_bytes in zip(entries, encoded):
+                    zipf.writestr(filename, png_bytes)
+                    yield from stream.drain()
+
+                # Include metadata JSON (orjson emits bytes directly)
+                zipf.writestr(
+                    f"{base_name}_metadata.json",
+                    orjson.dumps(result.get("metadata", {}), option=orjson.OPT_INDENT_2),
+                    compress_type=zipfile.ZIP_DEFLATED,
+                )
+            # Central directory written on close
+            yield from stream.drain()
 
         headers = {
             "Content-Disposition": f"attachment; filename=\"{base_name}_processed.zip\""
         }
-        return Response(content=zip_buffer.getvalue(), media_type="application/zip", headers=headers)
+        return StreamingResponse(iter_zip(), media_type="application/zip", headers=headers)
 
     except HTTPException:
         raise
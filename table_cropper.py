@@ -4,11 +4,71 @@ import cv2
 import numpy as np
 from PIL import Image
 import json
+import threading
+try:
+    import orjson  # much faster dumps; listed in requirements but optional here
+except ImportError:
+    orjson = None
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+
+def configure_parallelism(inner_threads=1):
+    """
+    Cap OpenCV's internal thread pool.
+
+    Every cv2 call in this module (resize, threshold, findContours, remap,
+    cvtColor) fans work out over a pool sized to the machine by default.
+    When process_image itself runs inside a worker pool, that multiplies
+    into workers x cores threads thrashing each other. Rule of thumb: one
+    inner thread per outer worker.
+
+    Args:
+        inner_threads (int): threads OpenCV may use; 0 disables its pool
+    """
+    cv2.setNumThreads(inner_threads)
+
+
+# Per-worker cropper for process_images; built once per pool process so the
+# warp-map cache survives across the files a worker handles
+_WORKER_CROPPER = None
+
+
+def _pool_initializer(inner_threads):
+    global _WORKER_CROPPER
+    configure_parallelism(inner_threads)
+    _WORKER_CROPPER = AdvancedTableCropper()
+
+
+def _pool_process(path, output_dir, return_images):
+    return _WORKER_CROPPER.process_image(path, output_dir=output_dir, return_images=return_images)
+
 
 class AdvancedTableCropper:
-    def __init__(self):
+    _WARP_MAP_CACHE_MAX = 4
+    _MATRIX_CACHE_MAX = 32
+
+    def __init__(self, debug=False):
+        # When debug is set, the save path also writes the diagnostic
+        # intermediates (corner overlay, cropped table, left-cropped table);
+        # production runs only pay for part1/part2 and the metadata JSON
+        self.debug = debug
         self.total_cols = 32
         self.total_rows = 17
+        self.detection_max_side = 1000.0
+        # Remap tables keyed by (rounded matrix, dst size); see _get_warp_maps
+        self._warp_map_cache = {}
+        # Thread-local reusable buffers: process_folder fans process_image
+        # out over a thread pool on one instance and the API shares one
+        # cropper across to_thread workers, so anything written in place
+        # must be private to the running thread
+        self._tls = threading.local()
+        # Perspective matrices keyed by (corners, dst geometry)
+        self._matrix_cache = {}
+        # Guards the capped matrix/warp-map dicts; their values are
+        # immutable once inserted, only the eviction needs serializing
+        self._cache_lock = threading.Lock()
+        # Pool for disk saves, so encoding one output overlaps writing another
+        self._save_pool = ThreadPoolExecutor(max_workers=4)
 
     def detect_table_corners(self, image):
         """
@@ -20,144 +80,282 @@ class AdvancedTableCropper:
         Returns:
             corners: List of 4 corner points [(x,y), ...]
         """
-        # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Apply Gaussian blur to reduce noise
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        
-        # Edge detection
-        edges = cv2.Canny(blurred, 50, 150, apertureSize=3)
-        
-        # Morphological operations to close gaps
-        kernel = np.ones((3, 3), np.uint8)
-        edges = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, kernel)
-        
-        # Find contours
-        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        # Find the largest rectangular contour
+        # Green channel stands in for luminance: it carries ~60% of the luma
+        # weight, table edges are high-contrast in every channel anyway, and
+        # extractChannel reads one byte in three instead of the weighted
+        # three-channel average BGR2GRAY computes.
+        gray = cv2.extractChannel(image, 1)
+        return self._detect_corners_gray(gray)
+
+    def _detect_corners_gray(self, gray):
+        """
+        Corner detection on a grayscale buffer; coordinates are returned in
+        that buffer's frame. Lets callers feed a decode-time grayscale image
+        (libjpeg decodes ~2x faster in grayscale mode) and skip the BGR->GRAY
+        raster pass entirely.
+        """
+        h, w = gray.shape[:2]
+
+        # Corner detection is a low-frequency task: run the whole edge/contour
+        # pipeline on a thumbnail (max side ~1000px) and scale the corners back
+        # up. Cuts per-pixel work by 4-16x on camera-resolution inputs.
+        scale = self.detection_max_side / max(h, w)
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        else:
+            scale = 1.0
+
+        # Box blur before binarizing. This is load-bearing, not just noise
+        # hygiene: it smears the dark gridlines into the bright cell interiors
+        # so Otsu keeps the table as one closed blob instead of hundreds of
+        # per-cell blobs that all fail the area floor. Blur and threshold
+        # share one scratch buffer per thread (threshold is elementwise, so
+        # in-place is safe; thread-local because concurrent detections must
+        # not blur into each other's buffer). A single buffer suffices: a
+        # batch from one camera shares a thumbnail shape, and reallocating on
+        # a shape change is cheap — while the shape is client-controlled, so
+        # a dict keyed on it would grow without bound on a long-lived server.
+        scratch = getattr(self._tls, "scratch", None)
+        if scratch is None or scratch.shape != gray.shape:
+            scratch = self._tls.scratch = np.empty(gray.shape, np.uint8)
+        blurred = cv2.blur(gray, (5, 5), dst=scratch)
+        _, edges = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU, dst=blurred)
+
+        # Find contours; TC89 keeps far fewer points per contour than SIMPLE,
+        # which makes the arcLength/approxPolyDP below proportionally cheaper
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_KCOS)
+
+        # Find the largest rectangular contour. Walk contours largest-first:
+        # the first quadrilateral we hit is the winner, and once areas drop
+        # below the minimum nothing later can qualify, so the loop ends
+        # after at most a handful of approxPolyDP calls.
+        contours = sorted(contours, key=cv2.contourArea, reverse=True)
         best_contour = None
-        max_area = 0
-        
+        min_area = gray.shape[0] * gray.shape[1] * 0.1
+
         for contour in contours:
+            if cv2.contourArea(contour) < min_area:
+                break
+
             # Approximate contour to polygon
             epsilon = 0.02 * cv2.arcLength(contour, True)
             approx = cv2.approxPolyDP(contour, epsilon, True)
-            
-            # Check if it's a quadrilateral and has significant area
+
+            # Check if it's a quadrilateral
             if len(approx) == 4:
-                area = cv2.contourArea(contour)
-                if area > max_area and area > (image.shape[0] * image.shape[1] * 0.1):
-                    max_area = area
-                    best_contour = approx
+                best_contour = approx
+                break
         
         if best_contour is not None:
-            # Convert to simple list of points
-            corners = []
-            for point in best_contour:
-                corners.append((point[0][0], point[0][1]))
-            
-            # Sort corners: top-left, top-right, bottom-right, bottom-left
-            corners = self.sort_corners(corners)
+            # approxPolyDP returns (4, 1, 2); flatten to (4, 2) without
+            # round-tripping through Python tuples
+            corners = self.sort_corners(best_contour.reshape(-1, 2))
+            if scale != 1.0:
+                # Map thumbnail coordinates back to the caller's frame
+                corners = corners / scale
             return corners
-        
-        # Fallback: use image boundaries with some margin
-        h, w = image.shape[:2]
-        margin = min(w, h) * 0.05
-        return [
-            (margin, margin),  # top-left
-            (w - margin, margin),  # top-right
-            (w - margin, h - margin),  # bottom-right
-            (margin, h - margin)  # bottom-left
-        ]
+
+        # No clean quadrilateral: take the minimum-area rectangle of the
+        # largest sufficiently-big contour. Still a usable warp target,
+        # unlike the frame-margin fallback which amounts to a 1:1 scale.
+        if contours and cv2.contourArea(contours[0]) >= min_area:
+            box = cv2.boxPoints(cv2.minAreaRect(contours[0]))
+            corners = self.sort_corners(box)
+            if scale != 1.0:
+                corners = corners / scale
+            return corners
+
+        # Last resort: use image boundaries with some margin; integer divide
+        # keeps the corners on whole pixels, so nothing downstream rounds
+        margin = min(w, h) // 20
+        return np.array([
+            [margin, margin],  # top-left
+            [w - margin, margin],  # top-right
+            [w - margin, h - margin],  # bottom-right
+            [margin, h - margin],  # bottom-left
+        ], dtype=np.float32)
     
     def sort_corners(self, corners):
         """
-        Sort corners in order: top-left, top-right, bottom-right, bottom-left
+        Sort corners in order: top-left, top-right, bottom-right, bottom-left.
+
+        Returns a (4, 2) float32 array.
         """
-        # Calculate center point
-        cx = sum(p[0] for p in corners) / 4
-        cy = sum(p[1] for p in corners) / 4
-        
-        # Sort by angle from center
-        def angle_from_center(point):
-            return np.arctan2(point[1] - cy, point[0] - cx)
-        
-        sorted_corners = sorted(corners, key=angle_from_center)
-        
-        # Ensure we start with top-left corner
-        # Find corner with minimum distance to (0,0)
-        min_dist = float('inf')
-        start_idx = 0
-        for i, corner in enumerate(sorted_corners):
-            dist = corner[0]**2 + corner[1]**2
-            if dist < min_dist:
-                min_dist = dist
-                start_idx = i
-        
-        # Reorder starting from top-left
-        reordered = sorted_corners[start_idx:] + sorted_corners[:start_idx]
-        return reordered
+        pts = np.asarray(corners, dtype=np.float32).reshape(4, 2)
+
+        # Split into top/bottom rows by y, then order each pair by x: left
+        # first on top, right first on bottom. Yields TL, TR, BR, BL directly
+        # with plain comparisons instead of the polar arctan2 sort.
+        idx = np.argsort(pts[:, 1])
+        top = pts[idx[:2]]
+        bottom = pts[idx[2:]]
+        top = top[np.argsort(top[:, 0])]
+        bottom = bottom[np.argsort(-bottom[:, 0])]
+        return np.vstack([top, bottom])
     
-    def apply_perspective_correction(self, image, corners, target_width=1240, target_height=850):
+    def corrected_table_width(self, target_width):
+        """Full corrected width: the table plus the margin after the 31st column."""
+        # At least 50px or 10% (increased from 5% to ensure 31st column is fully visible)
+        margin_pixels = max(50, int(target_width * 0.10))
+        return target_width + margin_pixels
+
+    def label_column_crop(self, table_width):
+        """Pixels spanned by the first (label) column plus a 10% safety margin."""
+        cell_width = table_width // self.total_cols
+        return cell_width + int(cell_width * 0.1)
+
+    def apply_perspective_correction(self, image, corners, target_width=1240, target_height=850,
+                                     high_quality=False, skip_label_column=False):
         """
         Apply perspective correction using the detected corners.
         Moves right corners 30px to the right before correction to capture 31st column fully.
-        
+
         Args:
             image: OpenCV image
             corners: List of 4 corner points
             target_width: Desired width of corrected image
             target_height: Desired height of corrected image
-            
+            high_quality: use Lanczos resampling (8x8 kernel) instead of the
+                default bilinear (2x2); barely distinguishable at this output
+                size but roughly 16x the per-pixel work
+            skip_label_column: fuse the first-column removal into the warp by
+                shifting the destination origin, so the label column's pixels
+                are never computed at all
+
         Returns:
             corrected_image: Perspective-corrected image with 31 columns + margin
+            (minus the label column when skip_label_column is set).
+            The array aliases a per-thread buffer reused across calls: this
+            thread's next call with the same output geometry overwrites it.
+            Callers that need the result to outlive that must .copy() it —
+            the internal pipeline does (saves resolve before reuse, and the
+            PIL branch copies via cvtColor).
         """
-        # Adjust right corners by moving them 30px to the right to capture 31st column
-        adjusted_corners = []
-        for i, corner in enumerate(corners):
-            if i == 1 or i == 2:  # Right corners (top-right and bottom-right)
-                # Move right corners 30px to the right
-                adjusted_corner = (corner[0] + 30, corner[1])
-                adjusted_corners.append(adjusted_corner)
-                print(f"Adjusted right corner {i+1}: {corner} → {adjusted_corner}")
-            else:
-                adjusted_corners.append(corner)
-        
-        # Source corners (adjusted to capture 31st column)
-        src_points = np.float32(adjusted_corners)
-        
-        # Calculate margin to add AFTER the 31st column
-        # We want to ensure all 31 columns fit, then add 10% or minimum 50px margin
-        margin_percent = 0.10  # 10% (increased from 5% to ensure 31st column is fully visible)
-        margin_pixels = max(50, int(target_width * margin_percent))  # At least 50px or 10%
+        # Source corners, with the right pair (top-right, bottom-right) moved
+        # 30px right to capture the 31st column; corners stay a (4, 2) float32
+        # array end to end, no tuple boxing
+        src_points = np.array(corners, dtype=np.float32)
+        src_points[1:3, 0] += 30
         
         # Final width includes all columns plus margin after 31st column
-        final_width = target_width + margin_pixels
-        
+        final_width = self.corrected_table_width(target_width)
+
+        # Optionally fold the label-column crop into the warp: shift the
+        # destination origin left and shrink the output, so those pixels are
+        # never interpolated or copied
+        left_crop = self.label_column_crop(final_width) if skip_label_column else 0
+
         # Destination corners (rectangle) - ensures full table + margin
         dst_points = np.float32([
-            [0, 0],  # top-left
-            [final_width, 0],  # top-right (includes margin after 31st column)
-            [final_width, target_height],  # bottom-right
-            [0, target_height]  # bottom-left
+            [-left_crop, 0],  # top-left
+            [final_width - left_crop, 0],  # top-right (includes margin after 31st column)
+            [final_width - left_crop, target_height],  # bottom-right
+            [-left_crop, target_height]  # bottom-left
         ])
-        
-        # Calculate perspective transformation matrix
-        matrix = cv2.getPerspectiveTransform(src_points, dst_points)
-        
-        # Apply perspective correction with Lanczos interpolation
-        # This gives us the full table with margin already included
-        corrected = cv2.warpPerspective(
-            image, 
-            matrix, 
-            (final_width, target_height),
-            flags=cv2.INTER_LANCZOS4
-        )
-        
+
+        # Perspective matrix, cached for repeated corner geometry (retries
+        # and re-requests on the same image hit the same quad); the 4x4
+        # Gaussian elimination inside getPerspectiveTransform is cheap but
+        # not free, and the key doubles as a stable handle for the warp maps
+        matrix_key = (src_points.tobytes(), final_width, target_height, left_crop)
+        matrix = self._matrix_cache.get(matrix_key)
+        if matrix is None:
+            matrix = cv2.getPerspectiveTransform(src_points, dst_points)
+            with self._cache_lock:
+                if len(self._matrix_cache) >= self._MATRIX_CACHE_MAX:
+                    self._matrix_cache.pop(next(iter(self._matrix_cache)))
+                self._matrix_cache[matrix_key] = matrix
+
+        # Apply perspective correction through cached remap tables; batches
+        # shot with the same geometry skip the per-pixel coordinate
+        # projection entirely
+        interpolation = cv2.INTER_LANCZOS4 if high_quality else cv2.INTER_LINEAR
+        dsize = (final_width - left_crop, target_height)
+        map1, map2 = self._get_warp_maps(matrix, dsize)
+        # Write into a per-thread reused buffer instead of allocating (and
+        # page-faulting) a fresh ~3MB output every call. The same buffer is
+        # returned by the thread's next call with matching geometry, so
+        # callers that need the previous result to survive must copy it
+        # first — both pipeline paths already do (saves resolve before
+        # return; the PIL branch copies via cvtColor).
+        dst = self._get_warp_dst(dsize, image)
+        corrected = cv2.remap(image, map1, map2, interpolation=interpolation, dst=dst)
+
         # No need to crop - we've already included the proper margin in the transformation
         return corrected
+
+    @staticmethod
+    def _write_metadata(path, metadata):
+        """Serialize metadata to disk; orjson when available, stdlib otherwise."""
+        if orjson is not None:
+            with open(path, 'wb') as f:
+                f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
+        else:
+            with open(path, 'w') as f:
+                json.dump(metadata, f, indent=2)
+
+    def _queue_save(self, path, img, compression=1):
+        """
+        Queue a PNG save on the background pool.
+
+        cv2.imwrite releases the GIL for both the PNG encode and the write,
+        so queued saves overlap each other and the ongoing pipeline work.
+        Default compression level 1 instead of OpenCV's 6: debug artifacts
+        are throwaway, and deeper DEFLATE is ~2x the CPU. Final outputs pass
+        a higher level since they may be kept or transferred.
+        """
+        return self._save_pool.submit(
+            cv2.imwrite, path, img, [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        )
+
+    def _get_warp_dst(self, dsize, image):
+        """
+        Reusable remap destination matching dsize and the source format.
+
+        Buffers live in thread-local storage: the output geometry is
+        constant, so a per-instance buffer would have every concurrent
+        pipeline run writing into the same array and silently corrupting
+        each other's warp output.
+        """
+        cache = getattr(self._tls, "warp_dst", None)
+        if cache is None:
+            cache = self._tls.warp_dst = {}
+        channels = image.shape[2] if image.ndim == 3 else 1
+        key = (dsize, channels, image.dtype.str)
+        dst = cache.get(key)
+        if dst is None:
+            width, height = dsize
+            shape = (height, width, channels) if channels > 1 else (height, width)
+            dst = np.empty(shape, dtype=image.dtype)
+            cache[key] = dst
+        return dst
+
+    def _get_warp_maps(self, matrix, dsize):
+        """
+        Build (and cache) fixed-point remap tables for a perspective warp.
+
+        cv2.warpPerspective re-projects every output pixel on every call;
+        precomputing the x/y lookup tables once per (matrix, size) reduces
+        repeat warps to a single cv2.remap gather.
+        """
+        key = (np.round(matrix, 3).tobytes(), dsize)
+        maps = self._warp_map_cache.get(key)
+        if maps is None:
+            width, height = dsize
+            inv = np.linalg.inv(matrix)
+            xs, ys = np.meshgrid(
+                np.arange(width, dtype=np.float32),
+                np.arange(height, dtype=np.float32),
+            )
+            denom = inv[2, 0] * xs + inv[2, 1] * ys + inv[2, 2]
+            map_x = ((inv[0, 0] * xs + inv[0, 1] * ys + inv[0, 2]) / denom).astype(np.float32)
+            map_y = ((inv[1, 0] * xs + inv[1, 1] * ys + inv[1, 2]) / denom).astype(np.float32)
+            maps = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+            with self._cache_lock:
+                if len(self._warp_map_cache) >= self._WARP_MAP_CACHE_MAX:
+                    self._warp_map_cache.pop(next(iter(self._warp_map_cache)))
+                self._warp_map_cache[key] = maps
+        return maps
     
     def calculate_cell_dimensions(self, image_width, image_height):
         """Calculate cell dimensions based on table structure."""
@@ -179,19 +377,22 @@ class AdvancedTableCropper:
             
         return image[:, crop_x:]
     
-    def crop_left_26_percent(self, image):
+    def crop_left_26_percent(self, image, shape=None):
         """
         Crop 26% from the left side of the image before splitting.
+
+        shape (h, w) may be passed when the caller already knows it, saving
+        the attribute lookups on repeat calls.
         """
-        h, w = image.shape[:2]
+        h, w = shape if shape is not None else image.shape[:2]
         crop_x = int(w * 0.26)  # 26% from left
         return image[:, crop_x:]
     
-    def split_into_equal_parts(self, image):
+    def split_into_equal_parts(self, image, shape=None):
         """
         Split image into two equal parts by rows.
         """
-        h, w = image.shape[:2]
+        h, w = shape if shape is not None else image.shape[:2]
         
         # Calculate split point for equal division
         # For 17 rows: first part gets 8 rows, second part gets 9 rows
@@ -203,7 +404,7 @@ class AdvancedTableCropper:
         
         return part1, part2
     
-    def process_image(self, input_path, output_dir=None, return_images=False):
+    def process_image(self, input_path, output_dir=None, return_images=False, debug=None):
         """
         Main processing function with perspective correction.
 
@@ -213,6 +414,8 @@ class AdvancedTableCropper:
                 a default ./output directory is used. If return_images is True, nothing is saved
                 unless an explicit output_dir is provided.
             return_images (bool): when True, return PIL Images in-memory instead of (or in addition to) saving.
+            debug (bool|None): per-call override for the instance debug flag;
+                when True the diagnostic intermediates are saved as well.
 
         Returns:
             - if return_images is True: dict with PIL Images {cropped_table, part1, part2, metadata}
@@ -220,146 +423,325 @@ class AdvancedTableCropper:
         """
         try:
             print(f"Loading image: {input_path}")
-            
+
             # Load image with OpenCV for processing
-            cv_image = cv2.imread(input_path)
+            original_size = self._peek_size(input_path)
+            long_side = max(original_size) if original_size else 0
+            cv_image = self._read_image(input_path, long_side)
             if cv_image is None:
                 raise ValueError(f"Could not load image: {input_path}")
-            
-            print(f"Original image dimensions: {cv_image.shape[1]} x {cv_image.shape[0]}")
-            
-            # Set up output directory only if we intend to save
-            should_save = output_dir is not None or (output_dir is None and not return_images)
-            if should_save:
-                if output_dir is None:
-                    script_dir = os.path.dirname(os.path.abspath(__file__))
-                    output_dir = os.path.join(script_dir, "output")
-                os.makedirs(output_dir, exist_ok=True)
-            
+
+            # Detect corners on a separate reduced grayscale decode: libjpeg
+            # skips the chroma work, and the reduction factor adapts to the
+            # source size (1/2, 1/4 or 1/8) so the decode lands near the
+            # detection thumbnail size instead of a fixed half resolution.
+            # Coordinates are rescaled to cv_image's frame; if the gray decode
+            # fails, _run_pipeline falls back to detecting on cv_image.
+            corners = None
+            gray = cv2.imread(input_path, self._reduced_gray_flag(long_side))
+            if gray is not None and gray.size:
+                corners = np.asarray(self._detect_corners_gray(gray), dtype=np.float32)
+                corners *= cv_image.shape[1] / gray.shape[1]
+
             # Get base filename
             input_filename = os.path.splitext(os.path.basename(input_path))[0]
-            
-            # Step 1: Detect table corners
-            print("Detecting table corners...")
-            corners = self.detect_table_corners(cv_image)
-            print(f"Detected corners: {corners}")
-            
-            # Corner visualization (saved only if saving is enabled)
-            if should_save:
-                corner_vis = cv_image.copy()
-                for i, corner in enumerate(corners):
-                    cv2.circle(corner_vis, (int(corner[0]), int(corner[1])), 10, (0, 0, 255), -1)
-                    cv2.putText(corner_vis, str(i+1), (int(corner[0])+15, int(corner[1])+15), 
-                               cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-                corner_vis_path = os.path.join(output_dir, f"{input_filename}_corners.png")
-                cv2.imwrite(corner_vis_path, corner_vis)
-                print(f"Corner detection saved: {corner_vis_path}")
-            
-            # Step 2: Apply perspective correction
-            print("Applying perspective correction...")
-            # Calculate target dimensions based on aspect ratio
-            target_width = 1240  # Approximate width for 31 columns
-            target_height = 850  # Approximate height for 17 rows
-            
-            corrected_image = self.apply_perspective_correction(
-                cv_image, corners, target_width, target_height
-            )
-            print(f"Perspective corrected dimensions: {corrected_image.shape[1]} x {corrected_image.shape[0]}")
-            
-            # Save perspective corrected image (optional)
-            if should_save:
-                corrected_path = os.path.join(output_dir, f"{input_filename}_perspective_corrected.png")
-                cv2.imwrite(corrected_path, corrected_image)
-                print(f"Perspective corrected image saved: {corrected_path}")
-            
-            # Step 3: Calculate cell dimensions on corrected image
-            cell_width, cell_height = self.calculate_cell_dimensions(
-                corrected_image.shape[1], corrected_image.shape[0]
-            )
-            print(f"Calculated cell dimensions: {cell_width} x {cell_height}")
-            
-            # Step 4: Remove first column
-            print("Removing first column (labels)...")
-            cropped_image = self.remove_first_column(corrected_image, cell_width)
-            
-            # Save cropped table (optional)
-            if should_save:
-                cropped_path = os.path.join(output_dir, f"{input_filename}_cropped_table.png")
-                cv2.imwrite(cropped_path, cropped_image)
-                print(f"Cropped table saved: {cropped_path}")
-            
-            # Step 5: Crop 26% from left before splitting
-            print("Cropping 26% from left side...")
-            left_cropped_image = self.crop_left_26_percent(cropped_image)
-            
-            # Save left-cropped table (optional)
-            if should_save:
-                left_cropped_path = os.path.join(output_dir, f"{input_filename}_left_cropped.png")
-                cv2.imwrite(left_cropped_path, left_cropped_image)
-                print(f"Left-cropped table saved: {left_cropped_path}")
-            
-            # Step 6: Split into equal parts
-            print("Splitting into equal parts...")
-            part1, part2 = self.split_into_equal_parts(left_cropped_image)
-            
-            # Save parts (optional)
-            if should_save:
-                part1_path = os.path.join(output_dir, f"{input_filename}_part1_rows1-8.png")
-                part2_path = os.path.join(output_dir, f"{input_filename}_part2_rows9-17.png")
-                cv2.imwrite(part1_path, part1)
-                cv2.imwrite(part2_path, part2)
-                print(f"Part 1 (rows 1-8) saved: {part1_path}")
-                print(f"Part 2 (rows 9-17) saved: {part2_path}")
-            
-            # Build processing metadata
-            metadata = {
-                "original_dimensions": f"{cv_image.shape[1]} x {cv_image.shape[0]}",
-                "corrected_dimensions": f"{corrected_image.shape[1]} x {corrected_image.shape[0]}",
-                "detected_corners": [[int(x), int(y)] for x, y in corners],
-                "cell_dimensions": f"{cell_width} x {cell_height}",
-            }
 
-            # Optional save processing metadata and record output file names
-            if should_save:
-                metadata["output_files"] = {}
-                if 'corner_vis_path' in locals():
-                    metadata["output_files"]["corners_visualization"] = os.path.basename(corner_vis_path)
-                if 'corrected_path' in locals():
-                    metadata["output_files"]["perspective_corrected"] = os.path.basename(corrected_path)
-                if 'cropped_path' in locals():
-                    metadata["output_files"]["cropped_table"] = os.path.basename(cropped_path)
-                if 'left_cropped_path' in locals():
-                    metadata["output_files"]["left_cropped"] = os.path.basename(left_cropped_path)
-                if 'part1_path' in locals():
-                    metadata["output_files"]["part1"] = os.path.basename(part1_path)
-                if 'part2_path' in locals():
-                    metadata["output_files"]["part2"] = os.path.basename(part2_path)
-                metadata_path = os.path.join(output_dir, f"{input_filename}_metadata.json")
-                with open(metadata_path, 'w') as f:
-                    json.dump(metadata, f, indent=2)
-            
-            if return_images:
-                # Convert OpenCV (BGR) arrays to PIL Images
-                def to_pil(bgr_img):
-                    rgb = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
-                    return Image.fromarray(rgb)
-                return {
-                    "cropped_table": to_pil(cropped_image),
-                    "part1": to_pil(part1),
-                    "part2": to_pil(part2),
-                    "metadata": metadata,
-                }
-            else:
-                if should_save:
-                    print("\n" + "="*60)
-                    print("PROCESSING COMPLETED SUCCESSFULLY!")
-                    print("="*60)
-                return True
-            
+            return self._run_pipeline(cv_image, input_filename, output_dir, return_images,
+                                      debug=debug, corners=corners, original_size=original_size)
+
         except Exception as e:
             print(f"\n❌ Error processing image: {str(e)}")
             import traceback
             traceback.print_exc()
             return False
 
+    @staticmethod
+    def _peek_size(input_path):
+        """Displayed (width, height) from the file header; None if unreadable."""
+        # PIL's open() only parses the header, so this is nearly free
+        try:
+            with Image.open(input_path) as im:
+                w, h = im.size
+                orientation = im.getexif().get(274, 1)
+        except Exception:
+            return None
+        # cv2.imread applies the EXIF orientation tag during decode; mirror
+        # it here so the reported frame matches the decoded one (orientations
+        # 5-8 are the transposed ones)
+        if orientation in (5, 6, 7, 8):
+            w, h = h, w
+        return (w, h)
+
+    @staticmethod
+    def _read_image(input_path, long_side=None):
+        """
+        Decode an image, at half resolution when the original is very large.
+
+        For camera-sized inputs (long side > 2000px) the decode itself
+        dominates load time; IMREAD_REDUCED_COLOR_2 has libjpeg do its IDCT
+        at 1/2 scale, which is ~4x fewer operations and a quarter of the
+        decoded buffer. The corners are detected on whatever buffer we return,
+        so downstream geometry needs no adjustment, and a half-scale camera
+        image still exceeds the 1318x850 corrected-output size.
+        """
+        if long_side is None:
+            size = AdvancedTableCropper._peek_size(input_path)
+            long_side = max(size) if size else 0
+
+        if long_side > 2000:
+            cv_image = cv2.imread(input_path, cv2.IMREAD_REDUCED_COLOR_2)
+            if cv_image is not None:
+                return cv_image
+        return cv2.imread(input_path)
+
+    def _reduced_gray_flag(self, long_side):
+        """
+        Deepest grayscale reduction that still lands at or above the
+        detection thumbnail size, so accuracy is unchanged while large scans
+        decode at 1/4 or 1/8 resolution (the JPEG DCT makes those nearly
+        free relative to a full decode).
+        """
+        if long_side >= self.detection_max_side * 8:
+            return cv2.IMREAD_REDUCED_GRAYSCALE_8
+        if long_side >= self.detection_max_side * 4:
+            return cv2.IMREAD_REDUCED_GRAYSCALE_4
+        if long_side >= self.detection_max_side * 2:
+            return cv2.IMREAD_REDUCED_GRAYSCALE_2
+        return cv2.IMREAD_GRAYSCALE
+
+    def process_folder(self, input_dir, output_dir=None, workers=8):
+        """
+        Process every image in a directory with a thread pool.
+
+        cv2.imread/imwrite release the GIL in their C layers, so threads
+        overlap decode, processing and encode across files.
+
+        Args:
+            input_dir (str): directory containing source images
+            output_dir (str|None): where to save outputs (see process_image)
+            workers (int): number of worker threads
+
+        Returns:
+            dict mapping each input path to its process_image result
+        """
+        extensions = (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".tif")
+        paths = sorted(
+            os.path.join(input_dir, name)
+            for name in os.listdir(input_dir)
+            if name.lower().endswith(extensions)
+        )
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.process_image, path, output_dir): path for path in paths}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        return results
+
+    def process_images(self, paths, output_dir=None, max_workers=None, return_images=False):
+        """
+        Process many images across a process pool.
+
+        Each worker pins OpenCV to one internal thread (see
+        configure_parallelism), so parallelism comes from one process per
+        core instead of nested thread pools oversubscribing the machine.
+
+        Args:
+            paths (list[str]): image paths to process
+            output_dir (str|None): where to save outputs (see process_image)
+            max_workers (int|None): pool size; defaults to the CPU count
+            return_images (bool): forwarded to process_image; note that PIL
+                results are pickled back from the workers, so prefer saving
+                to disk for large batches
+
+        Returns:
+            list of per-path results in input order
+        """
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_pool_initializer,
+            initargs=(1,),
+        ) as pool:
+            return list(pool.map(
+                _pool_process,
+                paths,
+                [output_dir] * len(paths),
+                [return_images] * len(paths),
+            ))
+
+    def process_image_bytes(self, data, filename="uploaded.png"):
+        """
+        Process an encoded image held in memory, skipping the filesystem entirely.
+
+        Args:
+            data (bytes): encoded image bytes (PNG/JPEG/etc.)
+            filename (str): original filename, used only for output naming.
+
+        Returns:
+            dict with PIL Images {cropped_table, part1, part2, metadata} on success,
+            False on failure (same contract as process_image).
+        """
+        try:
+            cv_image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if cv_image is None:
+                raise ValueError("Could not decode image buffer")
+
+            input_filename = os.path.splitext(os.path.basename(filename))[0]
+
+            return self._run_pipeline(cv_image, input_filename, None, True)
+
+        except Exception as e:
+            print(f"\n❌ Error processing image: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return False
+
+    def _run_pipeline(self, cv_image, input_filename, output_dir, return_images, debug=None,
+                      corners=None, original_size=None):
+        """Shared processing pipeline for the path- and bytes-based entry points."""
+        print(f"Original image dimensions: {cv_image.shape[1]} x {cv_image.shape[0]}")
+
+        # Set up output directory only if we intend to save
+        should_save = output_dir is not None or (output_dir is None and not return_images)
+        debug = self.debug if debug is None else debug
+        # Diagnostic intermediates (corner overlay, cropped/left-cropped
+        # tables) are only worth 3 extra PNG encodes when debugging
+        save_debug = should_save and debug
+        save_futures = []
+        if should_save:
+            if output_dir is None:
+                script_dir = os.path.dirname(os.path.abspath(__file__))
+                output_dir = os.path.join(script_dir, "output")
+            os.makedirs(output_dir, exist_ok=True)
+
+        # Step 1: Detect table corners (unless the caller already did, e.g.
+        # from a cheaper grayscale decode)
+        if corners is None:
+            print("Detecting table corners...")
+            corners = self.detect_table_corners(cv_image)
+        print(f"Detected corners: {corners}")
+
+        # Corner visualization (saved only when debugging). Copy just the
+        # bounding box around the corners instead of the full image: on a
+        # 4K input that's one table-sized copy and encode, not a 12 MP one.
+        if save_debug:
+            pts = np.asarray(corners)
+            margin = 40
+            x0 = max(int(pts[:, 0].min()) - margin, 0)
+            y0 = max(int(pts[:, 1].min()) - margin, 0)
+            x1 = min(int(pts[:, 0].max()) + margin, cv_image.shape[1])
+            y1 = min(int(pts[:, 1].max()) + margin, cv_image.shape[0])
+            corner_vis = cv_image[y0:y1, x0:x1].copy()
+            for i, corner in enumerate(corners):
+                cx, cy = int(corner[0]) - x0, int(corner[1]) - y0
+                cv2.circle(corner_vis, (cx, cy), 10, (0, 0, 255), -1)
+                cv2.putText(corner_vis, str(i+1), (cx + 15, cy + 15),
+                           cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+            corner_vis_path = os.path.join(output_dir, f"{input_filename}_corners.png")
+            save_futures.append(self._queue_save(corner_vis_path, corner_vis))
+            print(f"Corner detection saved: {corner_vis_path}")
+
+        # Step 2: Apply perspective correction with the label column fused
+        # out — the warp writes the already-cropped table directly, so the
+        # first column's pixels are never produced
+        print("Applying perspective correction (label column fused out)...")
+        # Calculate target dimensions based on aspect ratio
+        target_width = 1240  # Approximate width for 31 columns
+        target_height = 850  # Approximate height for 17 rows
+
+        cropped_image = self.apply_perspective_correction(
+            cv_image, corners, target_width, target_height, skip_label_column=True
+        )
+        # Read the corrected shape once; everything downstream (crop, split,
+        # metadata) works off the same pair
+        crop_h, crop_w = cropped_image.shape[:2]
+        print(f"Cropped table dimensions: {crop_w} x {crop_h}")
+
+        # Step 3: Cell dimensions refer to the full corrected table width
+        cell_width, cell_height = self.calculate_cell_dimensions(
+            self.corrected_table_width(target_width), target_height
+        )
+        print(f"Calculated cell dimensions: {cell_width} x {cell_height}")
+
+        # Save cropped table (debug only)
+        if save_debug:
+            cropped_path = os.path.join(output_dir, f"{input_filename}_cropped_table.png")
+            save_futures.append(self._queue_save(cropped_path, cropped_image))
+            print(f"Cropped table saved: {cropped_path}")
+
+        # Step 5: Crop 26% from left before splitting
+        print("Cropping 26% from left side...")
+        left_cropped_image = self.crop_left_26_percent(cropped_image, shape=(crop_h, crop_w))
+
+        # Save left-cropped table (debug only)
+        if save_debug:
+            left_cropped_path = os.path.join(output_dir, f"{input_filename}_left_cropped.png")
+            save_futures.append(self._queue_save(left_cropped_path, left_cropped_image))
+            print(f"Left-cropped table saved: {left_cropped_path}")
+
+        # Step 6: Split into equal parts
+        print("Splitting into equal parts...")
+        part1, part2 = self.split_into_equal_parts(left_cropped_image, shape=(crop_h, crop_w))
+
+        # Save parts (optional)
+        if should_save:
+            part1_path = os.path.join(output_dir, f"{input_filename}_part1_rows1-8.png")
+            part2_path = os.path.join(output_dir, f"{input_filename}_part2_rows9-17.png")
+            save_futures.append(self._queue_save(part1_path, part1, compression=3))
+            save_futures.append(self._queue_save(part2_path, part2, compression=3))
+            print(f"Part 1 (rows 1-8) saved: {part1_path}")
+            print(f"Part 2 (rows 9-17) saved: {part2_path}")
+
+        # Build processing metadata. Dimensions and corners are reported in
+        # the source file's frame: when the working decode was reduced (see
+        # _read_image), cv_image's shape is not what the caller uploaded.
+        orig_w, orig_h = original_size if original_size else (cv_image.shape[1], cv_image.shape[0])
+        to_source = orig_w / cv_image.shape[1]
+        metadata = {
+            "original_dimensions": f"{orig_w} x {orig_h}",
+            "corrected_dimensions": f"{crop_w} x {crop_h}",
+            "detected_corners": [[int(x * to_source), int(y * to_source)] for x, y in corners],
+            "cell_dimensions": f"{cell_width} x {cell_height}",
+        }
+
+        # Optional save processing metadata and record output file names
+        if should_save:
+            metadata["output_files"] = {}
+            if 'corner_vis_path' in locals():
+                metadata["output_files"]["corners_visualization"] = os.path.basename(corner_vis_path)
+            if 'cropped_path' in locals():
+                metadata["output_files"]["cropped_table"] = os.path.basename(cropped_path)
+            if 'left_cropped_path' in locals():
+                metadata["output_files"]["left_cropped"] = os.path.basename(left_cropped_path)
+            if 'part1_path' in locals():
+                metadata["output_files"]["part1"] = os.path.basename(part1_path)
+            if 'part2_path' in locals():
+                metadata["output_files"]["part2"] = os.path.basename(part2_path)
+            metadata_path = os.path.join(output_dir, f"{input_filename}_metadata.json")
+            save_futures.append(self._save_pool.submit(self._write_metadata, metadata_path, metadata))
+
+        # Wait for queued saves so write failures surface before returning
+        for future in save_futures:
+            future.result()
+
+        if return_images:
+            # Convert BGR->RGB once on the cropped table; the part crops are
+            # zero-copy NumPy views of that buffer, so PIL only materializes
+            # each region when the image is actually encoded.
+            cropped_rgb = cv2.cvtColor(cropped_image, cv2.COLOR_BGR2RGB)
+            left_cropped_rgb = self.crop_left_26_percent(cropped_rgb, shape=(crop_h, crop_w))
+            part1_rgb, part2_rgb = self.split_into_equal_parts(left_cropped_rgb, shape=(crop_h, crop_w))
+            return {
+                "cropped_table": Image.fromarray(cropped_rgb),
+                "part1": Image.fromarray(part1_rgb),
+                "part2": Image.fromarray(part2_rgb),
+                "metadata": metadata,
+            }
+        else:
+            if should_save:
+                print("\n" + "="*60)
+                print("PROCESSING COMPLETED SUCCESSFULLY!")
+                print("="*60)
+            return True
+
 